@@ -0,0 +1,114 @@
+import unittest
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest import mock
+
+from trade_client import RateLimiter
+from trade_client import ratelimit
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def rate_headers(policy: str, state: str) -> dict:
+    return {
+        "X-Rate-Limit-Rules": "Ip",
+        "X-Rate-Limit-Ip": policy,
+        "X-Rate-Limit-Ip-State": state,
+    }
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        patcher = mock.patch.object(ratelimit, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = RateLimiter()
+
+    def test_no_information_means_no_wait(self) -> None:
+        self.assertEqual(self.limiter.reserve("fetch"), 0.0)
+
+    def test_concurrent_fetches_stay_within_policy(self) -> None:
+        # 100 listings = 10 pages, 5 in flight at a time, against a 7 hits / 15s policy
+        max_hits, period, concurrency = 7, 15, 5
+        hits = []
+        in_flight = deque()
+
+        def answer() -> None:
+            self.limiter.update("fetch", in_flight.popleft())
+
+        for _ in range(10):
+            if len(in_flight) == concurrency:
+                answer()
+            self.clock.sleep(self.limiter.reserve("fetch"))
+            hits.append(self.clock.now)
+            recent = [h for h in hits if h > self.clock.now - period]
+            self.assertLessEqual(len(recent), max_hits)
+            in_flight.append(rate_headers(f"{max_hits}:{period}:60", f"{len(recent)}:{period}:0"))
+        while in_flight:
+            answer()
+
+        self.assertEqual(len(hits), 10)
+
+    def test_budget_coming_back_clears_the_wait(self) -> None:
+        self.limiter.reserve("fetch")
+        self.limiter.update("fetch", rate_headers("10:60:120", "9:60:0"))
+        self.assertGreater(self.limiter.reserve("fetch"), 0.0)
+
+        self.clock.sleep(5)
+        self.limiter.update("fetch", rate_headers("10:60:120", "0:60:0"))
+        self.assertEqual(self.limiter.reserve("fetch"), 0.0)
+
+    def test_penalty_is_not_shortened_by_later_responses(self) -> None:
+        self.limiter.reserve("fetch")
+        self.limiter.update("fetch", rate_headers("10:60:120", "11:60:120"))
+        self.limiter.reserve("fetch")
+        self.limiter.update("fetch", {})
+        self.assertEqual(self.limiter.reserve("fetch"), 120.0)
+
+    def test_buckets_are_independent(self) -> None:
+        self.limiter.reserve("search")
+        self.limiter.update("search", {"Retry-After": "30"})
+        self.assertEqual(self.limiter.reserve("fetch"), 0.0)
+
+    def test_rate_limited_without_headers_backs_off(self) -> None:
+        self.limiter.reserve("fetch")
+        self.limiter.update("fetch", {}, rate_limited=True)
+        self.assertGreater(self.limiter.reserve("fetch"), 0.0)
+
+    def test_retry_after_seconds(self) -> None:
+        self.limiter.reserve("fetch")
+        self.limiter.update("fetch", {"Retry-After": "30"})
+        self.assertEqual(self.limiter.reserve("fetch"), 30.0)
+
+    def test_retry_after_http_date(self) -> None:
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+        self.limiter.reserve("fetch")
+        self.limiter.update("fetch", {"Retry-After": format_datetime(retry_at, usegmt=True)})
+        self.assertAlmostEqual(self.limiter.reserve("fetch"), 30.0, delta=2.0)
+
+    def test_retry_after_in_the_past_or_invalid_is_ignored(self) -> None:
+        for value in ("Wed, 21 Oct 2015 07:28:00 GMT", "soon"):
+            self.limiter.reserve("fetch")
+            self.limiter.update("fetch", {"Retry-After": value})
+            self.assertEqual(self.limiter.reserve("fetch"), 0.0)
+            self.limiter.release("fetch")
+
+    def test_malformed_entries_are_skipped(self) -> None:
+        self.limiter.reserve("fetch")
+        self.limiter.update("fetch", rate_headers("10:60,7:15:60", "x,1:15:0"))
+        self.assertEqual(self.limiter.reserve("fetch"), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
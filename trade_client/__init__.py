@@ -1 +1,2 @@
 from .client import ClientConfig, SearchConfig, TradeClient
+from .ratelimit import RateLimiter
@@ -1,11 +1,18 @@
-import json
+from __future__ import annotations
+
+import asyncio
 import logging
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Callable, TypeVar, List, Dict, Any
+from itertools import islice
+from typing import Callable, TypeVar, List, Dict, Any, Iterator, AsyncIterator, Deque
 
+import httpx
+import orjson
 import requests
 import websocket
-from bokeh.core.serialization import DataType
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .models import (
     OnlineStatus,
@@ -15,11 +22,16 @@ from .models import (
     TradeRequest,
     SearchResponse,
     FetchResponse,
+    SearchResult,
     WhisperResponse,
     ItemListing,
 )
+from .ratelimit import RateLimiter
+
+# How many times a page is retried after a 429 before giving up
+_FETCH_RETRIES = 3
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ClientConfig:
     league: str
     poesessid: str  # could be replaced with OAuth
@@ -29,13 +41,15 @@ class ClientConfig:
             # have to fake the User-Agent to not get a 403
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/111.0",
             "Accept": "*/*",
+            # fetch responses are verbose JSON and compress very well
+            "Accept-Encoding": "br, gzip, deflate",
             "Content-Type": "application/json",
         }
     )
     log_level: int = logging.WARNING
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class SearchConfig:
     item_name: str
     item_type: str
@@ -51,7 +65,12 @@ class SearchConfig:
 
 class TradeClient:
     _config: ClientConfig
-    _sess: requests.Session | None = None
+    _sess: requests.Session
+    _base_headers: Dict[str, str]
+    _limiter: RateLimiter
+    _search_url: str
+    _fetch_prefix: str
+    _whisper_url: str
     _logger: logging.Logger
 
     def __init__(self, cfg: ClientConfig) -> None:
@@ -59,21 +78,66 @@ class TradeClient:
         logging.basicConfig(level=cfg.log_level)
         self._logger = logging.getLogger("TradeClient")
 
+        # copied so later changes to cfg.default_headers can't leak in
+        self._base_headers = dict(cfg.default_headers)
+        self._base_headers["Cookie"] = f"POESESSID={cfg.poesessid}"
+
+        # the config is frozen, so the endpoint URLs never change for this client
+        self._search_url = cfg.url + "search/" + cfg.league
+        self._fetch_prefix = cfg.url + "fetch/"
+        self._whisper_url = cfg.url + "whisper"
+
+        # one pooled session so every request reuses the same TCP+TLS connection
+        self._sess = requests.Session()
+        self._sess.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=16,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.3,
+                    # 429s are left to the rate limiter, retrying them blindly only extends a penalty
+                    status_forcelist=[502, 503, 504],
+                    # hand the last response back so _request can log it instead of raising
+                    raise_on_status=False,
+                ),
+            ),
+        )
+        # sent with every request, so the per-call headers only carry extras
+        self._sess.headers.update(self._base_headers)
+        self._limiter = RateLimiter()
+
+    # The session (connection pool + TLS state) and rate limiter are meant to
+    # outlive a single query: keep one client around for many searches and close it at the end.
+    def close(self) -> None:
+        self._sess.close()
+
+    def __enter__(self) -> TradeClient:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
     @property
     def config(self) -> ClientConfig:
         return self._config
 
-    def _build_headers(self, extras: Dict[str, str] = {}) -> Dict[str, str]:
-        # Create a copy of the default headers to avoid mutating the original
-        h = {**self.config.default_headers, **extras}
-        h["Cookie"] = f"POESESSID={self.config.poesessid}"
-        return h
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return self._limiter
+
+    def _build_headers(self, extras: Dict[str, str] | None = None) -> Dict[str, str]:
+        # Callers must not mutate the result, it is shared unless extras are given
+        if not extras:
+            return self._base_headers
+        return {**self._base_headers, **extras}
 
     def _build_search_url(self) -> str:
-        return self.config.url + "search/" + self.config.league
+        return self._search_url
 
     def _build_fetch_url(self, search_results: List[str]) -> str:
-        return self.config.url + "fetch/" + ",".join(search_results)
+        return self._fetch_prefix + ",".join(search_results)
 
     def _build_livesearch_url(self, query_id: str) -> str:
         return (
@@ -82,14 +146,24 @@ class TradeClient:
         )
 
     def _build_whisper_url(self) -> str:
-        return self.config.url + "whisper"
+        return self._whisper_url
 
-    def _request(self, req: requests.Request, raise_error: bool = True) -> requests.Response:
-        if not self._sess:
-            self._sess = requests.Session()
-
-        self._logger.debug(f"Request to send\n{req.__dict__}\n")
-        res = self._sess.send(req.prepare(), allow_redirects=True)
+    def _request(
+            self,
+            method: str,
+            url: str,
+            bucket: str,
+            raise_error: bool = True,
+            **kwargs: Any,
+    ) -> requests.Response:
+        self._logger.debug(f"Request to send\n{method} {url} {kwargs}\n")
+        self._limiter.wait_if_needed(bucket)
+        try:
+            res = self._sess.request(method, url, allow_redirects=True, **kwargs)
+        except BaseException:
+            self._limiter.release(bucket)
+            raise
+        self._limiter.update(bucket, res.headers, rate_limited=res.status_code == 429)
         self._logger.debug(f"Full response {res.__dict__}")
         if raise_error :
             try:
@@ -100,40 +174,43 @@ class TradeClient:
 
     def _search(self, req: TradeRequest) -> SearchResponse:
         res = self._request(
-            requests.Request(
-                method="POST",
-                url=self._build_search_url(),
-                headers=self._build_headers(),
-                data=json.dumps(req),
-            )
+            "POST",
+            self._build_search_url(),
+            "search",
+            data=orjson.dumps(req),
         )
-        return res.json()
+        return orjson.loads(res.content)
+
+    def _parse_fetch(self, body: bytes) -> FetchResponse:
+        # Listings are handed out and written in full, so a lazy parser has nothing to skip.
+        # An error response comes back as {"error": {...}} for the caller to inspect.
+        fetch_res = orjson.loads(body)
+        if not isinstance(fetch_res, dict):
+            return {}  # type: ignore
+        return fetch_res
 
     def _fetch(self, built_url: str, query_id: str) -> FetchResponse:
         res = self._request(
-            requests.Request(
-                method="GET",
-                url=built_url,
-                params={"query": query_id},
-                headers=self._build_headers(),
-            )
+            "GET",
+            built_url,
+            "fetch",
+            params={"query": query_id},
         )
-        return res.json()
+        return self._parse_fetch(res.content)
 
     def _whisper(self, whisper_token: str) -> WhisperResponse:
         res = self._request(
-            requests.Request(
-                method="POST",
-                url=self._build_whisper_url(),
-                data=json.dumps({"token": whisper_token}),
-                headers=self._build_headers({"X-Requested-With": "XMLHttpRequest"}),
-            ),
+            "POST",
+            self._build_whisper_url(),
+            "whisper",
             raise_error=False,
+            data=orjson.dumps({"token": whisper_token}),
+            headers={"X-Requested-With": "XMLHttpRequest"},
         )
         # Not all responses might be JSON
         try:
-            return res.json()
-        except json.JSONDecodeError:
+            return orjson.loads(res.content)
+        except orjson.JSONDecodeError:
             self._logger.warning("Whisper response was not valid JSON.")
             return {"error": {"message": "Invalid JSON response"}}
 
@@ -154,21 +231,10 @@ class TradeClient:
     def _build_pages(
             self, all_results: List[_TPage], page_width: int = 10
     ) -> List[List[_TPage]]:
-        if len(all_results) <= page_width:
-            return [all_results]
-
-        pages: List[List[_TPage]] = []
-        page: List[_TPage] = []
-        for r in all_results:
-            if len(page) < page_width:
-                page.append(r)
-            else:
-                pages.append(page)
-                page = [r]
-
-        if page:  # append any leftover items
-            pages.append(page)
-        return pages
+        return [
+            all_results[i:i + page_width]
+            for i in range(0, len(all_results), page_width)
+        ]
 
     def _build_ws_message_handler(
             self,
@@ -178,8 +244,8 @@ class TradeClient:
         def on_message(ws: websocket.WebSocketApp, msg: str):
             self._logger.debug(f"Received msg {msg}")
             try:
-                msg_data = json.loads(msg)
-            except json.JSONDecodeError:
+                msg_data = orjson.loads(msg)
+            except orjson.JSONDecodeError:
                 self._logger.warning("Received invalid JSON message.")
                 return
 
@@ -205,6 +271,92 @@ class TradeClient:
         fetch_res = self._fetch(self._build_fetch_url(paged_ids[0]), search_res["id"])
         return fetch_res
 
+    def _start_search(self, cfg: SearchConfig) -> SearchResponse | None:
+        search_res = self._search(self._build_trade_request(cfg))
+        if "result" not in search_res:
+            self._logger.warning("Search returned no 'result' field.")
+            return None
+        if "id" not in search_res:
+            self._logger.warning("Search returned no 'id' field.")
+            return None
+        return search_res
+
+    def _page_listings(self, status: int, body: bytes) -> List[SearchResult]:
+        # A page that can't be read stops the whole search,
+        # a missing page must not look like a shorter result list
+        try:
+            fetch_res = self._parse_fetch(body)
+        except orjson.JSONDecodeError:
+            fetch_res = {}  # type: ignore
+        if status >= 400 or "result" not in fetch_res:
+            raise RuntimeError(f"Fetch failed with HTTP {status}: {fetch_res.get('error')}")
+        return fetch_res["result"]
+
+    def _iter_search(self, cfg: SearchConfig) -> Iterator[SearchResult]:
+        search_res = self._start_search(cfg)
+        if search_res is None:
+            return
+
+        for page in self._build_pages(search_res["result"]):
+            url = self._build_fetch_url(page)
+            for _ in range(_FETCH_RETRIES + 1):
+                res = self._request(
+                    "GET", url, "fetch", raise_error=False, params={"query": search_res["id"]}
+                )
+                if res.status_code != 429:
+                    break
+                self._logger.warning("Rate limited while fetching, retrying page.")
+            yield from self._page_listings(res.status_code, res.content)
+
+    async def _aiter_search(
+            self, cfg: SearchConfig, concurrency: int
+    ) -> AsyncIterator[SearchResult]:
+        search_res = await asyncio.to_thread(self._start_search, cfg)
+        if search_res is None:
+            return
+        query_id = search_res["id"]
+
+        # HTTP/2 multiplexes every page over a single TCP+TLS connection
+        async with httpx.AsyncClient(
+            http2=True,
+            headers=self._base_headers,
+            limits=httpx.Limits(max_keepalive_connections=4),
+        ) as session:
+            async def fetch_page(page: List[str]) -> List[SearchResult]:
+                url = self._build_fetch_url(page)
+                for _ in range(_FETCH_RETRIES + 1):
+                    # the slot is claimed before sending, so requests in flight count too
+                    wait = self._limiter.reserve("fetch")
+                    try:
+                        await asyncio.sleep(wait)
+                        res = await session.get(url, params={"query": query_id})
+                    except BaseException:
+                        self._limiter.release("fetch")
+                        raise
+                    self._limiter.update("fetch", res.headers, rate_limited=res.status_code == 429)
+                    if res.status_code != 429:
+                        break
+                    self._logger.warning("Rate limited while fetching, retrying page.")
+                return self._page_listings(res.status_code, res.content)
+
+            # Only `concurrency` pages are fetched ahead of the one being consumed,
+            # so a slow consumer holds back the fetches instead of piling up pages.
+            pages = iter(self._build_pages(search_res["result"]))
+            window: Deque[asyncio.Task[List[SearchResult]]] = deque(
+                asyncio.create_task(fetch_page(page)) for page in islice(pages, concurrency)
+            )
+            try:
+                # awaiting in page order keeps the price sort of the search
+                while window:
+                    listings = await window.popleft()
+                    for page in islice(pages, 1):
+                        window.append(asyncio.create_task(fetch_page(page)))
+                    for listing in listings:
+                        yield listing
+            finally:
+                for task in window:
+                    task.cancel()
+
     def _live_search(self, cfg: SearchConfig) -> None:
         if self.config.log_level <= logging.DEBUG:
             websocket.enableTrace(True)
@@ -229,6 +381,22 @@ class TradeClient:
             return None
         return self._normal_search(cfg)
 
+    def search_iter(self, cfg: SearchConfig) -> Iterator[SearchResult]:
+        # Unlike search(), this walks every page of results, fetching each page
+        # only when the previous one has been consumed. Live searches aren't supported.
+        if cfg.live:
+            raise ValueError("search_iter does not support live searches")
+        return self._iter_search(cfg)
+
+    def search_aiter(
+            self, cfg: SearchConfig, concurrency: int = 5
+    ) -> AsyncIterator[SearchResult]:
+        # Async counterpart of search_iter(): up to `concurrency` pages are fetched at once
+        # over HTTP/2 and the listings still come out in search order.
+        if cfg.live:
+            raise ValueError("search_aiter does not support live searches")
+        return self._aiter_search(cfg, concurrency)
+
     def whisper(self, listing: ItemListing) -> WhisperResponse:
         r = self._whisper(listing["whisper_token"])
         if "error" in r:
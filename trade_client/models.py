@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 from typing import Any, Literal, Optional, TypedDict, TypeVar, Generic, List, Dict
 
 class StatFilterValue(TypedDict, total=False):
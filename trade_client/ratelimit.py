@@ -0,0 +1,144 @@
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Mapping, Tuple
+
+# how long to back off after a 429 that carried no rate limit information
+_FALLBACK_PENALTY = 10.0
+
+
+def _parse_retry_after(value: str) -> float:
+    # Retry-After is either a number of seconds or an HTTP-date
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.0
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+@dataclass(slots=True)
+class _Window:
+    max_hits: int
+    period: int
+    left: int
+    # once the window is used up, when all of our hits have rolled out of it
+    reset_at: float = 0.0
+
+
+@dataclass(slots=True)
+class _Bucket:
+    windows: Dict[Tuple[str, int], _Window] = field(default_factory=dict)
+    in_flight: int = 0
+    blocked_until: float = 0.0
+
+
+class RateLimiter:
+    """Paces requests using the trade API's X-Rate-Limit-* response headers.
+
+    Each rule named in X-Rate-Limit-Rules (e.g. "Ip,Account") comes with a
+    policy header like "7:15:60,15:90:120" (max hits : period : penalty) and a
+    state header like "3:15:0,3:90:0" (hits : period : active penalty), one
+    entry per window. Requests only wait once a window is about to run out.
+
+    Endpoints are limited separately, so state is kept per bucket (e.g.
+    "search", "fetch"). Every request must reserve() a slot before it is sent
+    and hand its response to update() (or release() the slot if it failed),
+    so requests still in flight count against the budget.
+    """
+
+    _margin: int
+    _buckets: Dict[str, _Bucket]
+
+    def __init__(self, margin: int = 1) -> None:
+        # how many hits to keep in reserve in every window
+        self._margin = margin
+        self._buckets = {}
+
+    def _bucket(self, name: str) -> _Bucket:
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            bucket = self._buckets[name] = _Bucket()
+        return bucket
+
+    def reserve(self, bucket_name: str) -> float:
+        # Claims a slot for one request and returns how long to wait before sending it
+        bucket = self._bucket(bucket_name)
+        now = time.monotonic()
+        start = max(now, bucket.blocked_until)
+        for w in bucket.windows.values():
+            # reset_at is only ever in the future for a window we have used up
+            # (or just refilled for requests scheduled at reset_at), so wait for it
+            start = max(start, w.reset_at)
+
+        for w in bucket.windows.values():
+            if w.left <= self._margin and start >= w.reset_at:
+                # we waited out the whole window, so none of our hits are left in it
+                w.left = w.max_hits - bucket.in_flight
+            w.left -= 1
+            if w.left <= self._margin:
+                w.reset_at = max(w.reset_at, start + w.period)
+
+        bucket.in_flight += 1
+        return start - now
+
+    def release(self, bucket_name: str) -> None:
+        bucket = self._bucket(bucket_name)
+        bucket.in_flight = max(0, bucket.in_flight - 1)
+
+    def wait_if_needed(self, bucket_name: str) -> None:
+        wait = self.reserve(bucket_name)
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(
+            self, bucket_name: str, headers: Mapping[str, str], rate_limited: bool = False
+    ) -> None:
+        self.release(bucket_name)
+        bucket = self._bucket(bucket_name)
+        now = time.monotonic()
+        wait = 0.0
+
+        retry_after = headers.get("Retry-After")
+        if retry_after:
+            wait = _parse_retry_after(retry_after)
+
+        for rule in headers.get("X-Rate-Limit-Rules", "").split(","):
+            rule = rule.strip()
+            policy = headers.get(f"X-Rate-Limit-{rule}")
+            state = headers.get(f"X-Rate-Limit-{rule}-State")
+            if not rule or not policy or not state:
+                continue
+
+            for limit, current in zip(policy.split(","), state.split(",")):
+                try:
+                    max_hits, period, _ = (int(v) for v in limit.split(":"))
+                    hits, _, penalty = (int(v) for v in current.split(":"))
+                except ValueError:
+                    # a malformed entry must not break a response we already received
+                    continue
+                if penalty:
+                    wait = max(wait, float(penalty))
+
+                w = bucket.windows.get((rule, period))
+                if w is None:
+                    w = bucket.windows[(rule, period)] = _Window(max_hits, period, max_hits)
+                # the server hasn't counted the requests we still have in flight
+                w.max_hits = max_hits
+                w.left = max_hits - hits - bucket.in_flight
+                if w.left > self._margin:
+                    # the server says the budget is back, stop waiting on this window
+                    w.reset_at = 0.0
+                elif w.reset_at <= now:
+                    w.reset_at = now + period
+
+        if rate_limited and not wait:
+            wait = _FALLBACK_PENALTY
+        # a late or unrelated response must never shorten a penalty that is already active
+        bucket.blocked_until = max(bucket.blocked_until, now + wait)